@@ -3,22 +3,123 @@
 Скрипт автоматической настройки AmneziaWG Config Bot
 Извлекает параметры из Docker контейнера и настраивает .env файл
 """
-import subprocess
 import os
 import sys
-import re
+import signal
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from ipaddress import IPv4Address, IPv4Interface
 from pathlib import Path
+from subprocess import DEVNULL, PIPE, Popen, run as _sp_run
 
+AWG_CONTAINER = 'amnezia-awg'
+AWG_CONFIG_FILE = '/opt/amnezia/awg/wg0.conf'
 
-def run_command(command):
-    """Выполнение команды и возврат результата"""
+# Таймаут внешних команд (docker, curl), секунды
+_TIMEOUT = 10
+
+# Ответ сервиса определения IP длиннее этого - заведомо не IP адрес
+_PROBE_MAX_CHARS = 64
+
+# Разделитель между содержимым wg0.conf и публичным ключом сервера
+PUBKEY_SENTINEL = '---AWG-PUBKEY---'
+
+# Параметры обфускации AmneziaWG в секции [Interface]
+AWG_PARAMS = ('Jc', 'Jmin', 'Jmax', 'S1', 'S2', 'H1', 'H2', 'H3', 'H4')
+
+# Значения по умолчанию для полей ServerConfig, не найденных в wg0.conf
+ENV_DEFAULTS = {
+    'port': '443',
+    'server_public_key': '',
+    'preshared_key': '',
+    'client_network': '10.8.1.0/24',
+    'client_ip_start': '10.8.1.2',
+    'jc': '2',
+    'jmin': '10',
+    'jmax': '50',
+    's1': '105',
+    's2': '72',
+    'h1': '1632458931',
+    'h2': '1121810837',
+    'h3': '697439987',
+    'h4': '1960185003',
+}
+
+# Шаблон .env файла (строки подставляются через str.format)
+ENV_TEMPLATE_LINES = (
+    '# Telegram Bot Configuration',
+    'BOT_TOKEN={bot_token}',
+    '',
+    '# Admin Configuration',
+    'ADMIN_ID={admin_id}',
+    '',
+    '# Allowed Users (comma-separated Telegram IDs)',
+    'USERS={users}',
+    '',
+    '# AmneziaWG Configuration',
+    f'AWG_CONTAINER={AWG_CONTAINER}',
+    'AWG_CONFIG_PATH=/opt/amnezia/awg',
+    'SERVER_ENDPOINT={server_ip}:{port}',
+    'SERVER_PUBLIC_KEY={server_public_key}',
+    'PRESHARED_KEY={preshared_key}',
+    '',
+    '# Network Configuration',
+    'CLIENT_NETWORK={client_network}',
+    'CLIENT_IP_START={client_ip_start}',
+    '',
+    '# AmneziaWG Parameters',
+    'JC={jc}',
+    'JMIN={jmin}',
+    'JMAX={jmax}',
+    'S1={s1}',
+    'S2={s2}',
+    'H1={h1}',
+    'H2={h2}',
+    'H3={h3}',
+    'H4={h4}',
+    '',
+    '# DNS Servers',
+    'DNS_SERVERS=1.1.1.1,1.0.0.1',
+    '',
+    '# Database',
+    'DATABASE_PATH=data/database.db',
+    '',
+    '# Logging',
+    'LOG_LEVEL=INFO',
+    'LOG_FILE=logs/bot.log',
+    '',
+)
+
+
+@dataclass(frozen=True, slots=True)
+class ServerConfig:
+    """Параметры сервера, извлеченные из wg0.conf (None - не найден)"""
+    server_public_key: str | None = None
+    preshared_key: str | None = None
+    port: str | None = None
+    client_network: str | None = None
+    client_ip_start: str | None = None
+    jc: str | None = None
+    jmin: str | None = None
+    jmax: str | None = None
+    s1: str | None = None
+    s2: str | None = None
+    h1: str | None = None
+    h2: str | None = None
+    h3: str | None = None
+    h4: str | None = None
+
+
+def run_command(argv):
+    """Выполнение команды (список аргументов, без shell) и возврат результата"""
     try:
-        result = subprocess.run(
-            command,
-            shell=True,
-            capture_output=True,
+        result = _sp_run(
+            argv,
+            stdout=PIPE,
+            # stderr не используется, ошибки сообщаем сами по коду возврата
+            stderr=DEVNULL,
             text=True,
-            timeout=10
+            timeout=_TIMEOUT
         )
         return result.stdout.strip(), result.returncode
     except Exception as e:
@@ -26,110 +127,228 @@ def run_command(command):
         return "", 1
 
 
-def check_docker():
-    """Проверка наличия Docker"""
-    print("🔍 Проверка Docker...")
-    output, code = run_command("docker --version")
+def start_command(argv):
+    """Запуск команды без ожидания завершения; возвращает Popen"""
+    return Popen(
+        argv,
+        stdout=PIPE,
+        stderr=DEVNULL,
+        text=True,
+        # Отдельная группа процессов, чтобы kill_command завершал и дочерние
+        start_new_session=True
+    )
+
+
+def kill_command(proc):
+    """Принудительное завершение команды, запущенной через start_command"""
+    if proc.poll() is None:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def read_probe_output(proc):
+    """Чтение начала ответа команды; при длинном ответе команда прерывается"""
+    output = proc.stdout.read(_PROBE_MAX_CHARS)
+    if len(output) < _PROBE_MAX_CHARS:
+        # Достигнут конец вывода - дожидаемся кода возврата
+        proc.wait()
+    else:
+        kill_command(proc)
+        proc.wait()
+    return output
+
+
+def check_docker_and_container():
+    """Проверка наличия Docker и контейнера AmneziaWG одним вызовом docker ps"""
+    print("🔍 Проверка Docker и контейнера AmneziaWG...")
+    output, code = run_command([
+        "docker", "ps",
+        "--filter", f"name={AWG_CONTAINER}",
+        "--format", "{{.Names}} ({{.Image}})"
+    ])
     if code != 0:
         print("❌ Docker не установлен или недоступен")
         return False
-    print(f"✅ {output}")
-    return True
-
-
-def check_amnezia_container():
-    """Проверка наличия контейнера AmneziaWG"""
-    print("\n🔍 Проверка контейнера AmneziaWG...")
-    output, code = run_command("docker ps --filter name=amnezia-awg --format '{{.Names}}'")
-    if code != 0 or not output:
-        print("❌ Контейнер amnezia-awg не найден или не запущен")
+    if not output:
+        print(f"❌ Контейнер {AWG_CONTAINER} не найден или не запущен")
         print("   Убедитесь, что AmneziaWG установлен и работает")
         return False
     print(f"✅ Контейнер найден: {output}")
     return True
 
 
-def get_server_config():
-    """Получение конфигурации сервера из контейнера"""
+# Успешно прочитанные конфигурации по имени контейнера
+_server_configs = {}
+
+
+def get_server_config(container=AWG_CONTAINER):
+    """Получение конфигурации сервера (кэшируется только успешный результат)"""
+    config = _server_configs.get(container)
+    if config is None:
+        config = read_server_config(container)
+        if config is not None:
+            _server_configs[container] = config
+    return config
+
+
+def read_server_config(container):
+    """Чтение и разбор конфигурации сервера из контейнера"""
     print("\n📋 Чтение конфигурации сервера...")
     
-    # Читаем конфигурацию
-    config_cmd = "docker exec amnezia-awg cat /opt/amnezia/awg/wg0.conf"
-    config_output, code = run_command(config_cmd)
+    # Читаем конфигурацию и получаем публичный ключ сервера из приватного
+    # за один docker exec; части вывода разделены PUBKEY_SENTINEL
+    script = (
+        f"cat {AWG_CONFIG_FILE} || exit 1; "
+        f"echo \"{PUBKEY_SENTINEL}\"; "
+        "sed -n 's/^[[:space:]]*PrivateKey[[:space:]]*=[[:space:]]*"
+        f"\\([^[:space:]]*\\).*/\\1/p' {AWG_CONFIG_FILE} | head -n1 | wg pubkey"
+    )
+    output, code = run_command(["docker", "exec", container, "sh", "-c", script])
     
-    if code != 0:
+    # Ненулевой код после разделителя - ошибка wg pubkey, а не чтения
+    # конфигурации; о ней предупреждает parse_server_config
+    if code != 0 and PUBKEY_SENTINEL not in output:
         print("❌ Не удалось прочитать конфигурацию")
         return None
     
+    config_output, _, public_key = output.partition(PUBKEY_SENTINEL)
+    public_key = public_key.strip()
+    
+    return parse_server_config(config_output, public_key)
+
+
+def parse_server_config(config_output, public_key):
+    """Разбор содержимого wg0.conf в ServerConfig; None, если параметров нет"""
+    # Разбираем конфигурацию за один проход: ключи сохраняем по первому
+    # вхождению, AllowedIPs из всех секций [Peer] накапливаем в список
+    kv = {}
+    allowed_ips = []
+    section = None
+    for line in config_output.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('['):
+            section = line
+            continue
+        key, sep, value = line.partition('=')
+        if not sep:
+            continue
+        key, value = key.strip(), value.strip()
+        if key == 'AllowedIPs':
+            if section == '[Peer]':
+                # IPv6 адреса (в т.ч. с префиксом /32) пропускаем
+                allowed_ips.extend(
+                    ip.strip()[:-3] for ip in value.split(',')
+                    if ip.strip().endswith('/32') and ':' not in ip
+                )
+        else:
+            kv.setdefault(key, value)
+    
     config = {}
     
-    # Извлекаем параметры из конфигурации
     # Публичный ключ сервера
-    public_key_match = re.search(r'PublicKey\s*=\s*(\S+)', config_output)
-    if public_key_match:
-        # Нужно получить публичный ключ сервера из приватного
-        private_key_match = re.search(r'PrivateKey\s*=\s*(\S+)', config_output)
-        if private_key_match:
-            private_key = private_key_match.group(1)
-            pubkey_cmd = f"echo '{private_key}' | docker exec -i amnezia-awg wg pubkey"
-            public_key, _ = run_command(pubkey_cmd)
-            config['SERVER_PUBLIC_KEY'] = public_key
+    if kv.get('PrivateKey') and not public_key:
+        print("⚠️  Не удалось получить публичный ключ сервера из PrivateKey")
+    if 'PublicKey' in kv and kv.get('PrivateKey'):
+        config['server_public_key'] = public_key
     
     # PresharedKey из секции [Peer]
-    psk_match = re.search(r'PresharedKey\s*=\s*(\S+)', config_output)
-    if psk_match:
-        config['PRESHARED_KEY'] = psk_match.group(1)
+    if kv.get('PresharedKey'):
+        config['preshared_key'] = kv['PresharedKey']
     
     # ListenPort
-    port_match = re.search(r'ListenPort\s*=\s*(\d+)', config_output)
-    if port_match:
-        config['PORT'] = port_match.group(1)
+    if kv.get('ListenPort', '').isdigit():
+        config['port'] = kv['ListenPort']
     
     # AmneziaWG параметры
-    for param in ['Jc', 'Jmin', 'Jmax', 'S1', 'S2', 'H1', 'H2', 'H3', 'H4']:
-        match = re.search(f'{param}\\s*=\\s*(\\d+)', config_output)
-        if match:
-            config[param.upper()] = match.group(1)
-    
-    # Сеть клиентов
-    address_match = re.search(r'Address\s*=\s*([0-9.]+/\d+)', config_output)
-    if address_match:
-        network = address_match.group(1)
-        config['CLIENT_NETWORK'] = network
-        # Определяем стартовый IP для клиентов
-        base_ip = network.split('/')[0]
-        octets = base_ip.split('.')
-        # Берем следующий IP после сервера (обычно .1)
-        next_ip = '.'.join(octets[:-1] + [str(max(2, int(octets[-1]) + 1))])
+    for param in AWG_PARAMS:
+        if kv.get(param, '').isdigit():
+            config[param.lower()] = kv[param]
+    
+    # Сеть клиентов: первый IPv4 адрес из Address (IPv6 пропускаем)
+    interface = None
+    for entry in kv.get('Address', '').split(','):
+        entry = entry.strip()
+        if '/' not in entry or ':' in entry:
+            continue
+        try:
+            interface = IPv4Interface(entry)
+        except ValueError as e:
+            print(f"❌ Некорректный адрес в конфигурации: {e}")
+            return None
+        config['client_network'] = entry
+        break
+    
+    if interface is not None:
+        net = interface.network
+        # Адрес сервера и уже выданные клиентам IP считаются занятыми;
+        # минимум - следующий IP после сервера (обычно .1)
+        used = {int(net.network_address) + 1, int(interface.ip)}
+        for ip in allowed_ips:
+            # Некорректный адрес одного пира не должен прерывать настройку
+            try:
+                address = IPv4Address(ip)
+            except ValueError as e:
+                print(f"⚠️  Пропущен некорректный AllowedIPs: {e}")
+                continue
+            if address in net:
+                used.add(int(address))
         
-        # Проверяем, какие IP уже заняты
-        allowed_ips = re.findall(r'AllowedIPs\s*=\s*([0-9.]+)/32', config_output)
-        if allowed_ips:
-            used_octets = [int(ip.split('.')[-1]) for ip in allowed_ips]
-            max_used = max(used_octets) if used_octets else 1
-            next_ip = '.'.join(octets[:-1] + [str(max_used + 1)])
+        next_ip = IPv4Address(max(used) + 1)
+        if not net.network_address < next_ip < net.broadcast_address:
+            print(f"❌ В сети {net} не осталось свободных IP для клиентов")
+            return None
         
-        config['CLIENT_IP_START'] = next_ip
+        config['client_ip_start'] = str(next_ip)
     
-    return config
+    return ServerConfig(**config) if config else None
 
 
 def get_server_ip():
     """Получение внешнего IP адреса сервера"""
     print("\n🌐 Определение внешнего IP адреса...")
     
-    # Пробуем разные сервисы
+    # Опрашиваем сервисы параллельно и берем первый корректный ответ
     services = [
-        "curl -s ifconfig.me",
-        "curl -s icanhazip.com",
-        "curl -s ipinfo.io/ip"
+        ["curl", "-s", "ifconfig.me"],
+        ["curl", "-s", "icanhazip.com"],
+        ["curl", "-s", "ipinfo.io/ip"]
     ]
     
+    procs = []
     for service in services:
-        ip, code = run_command(service)
-        if code == 0 and ip and re.match(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$', ip):
-            print(f"✅ Внешний IP: {ip}")
-            return ip
+        try:
+            procs.append(start_command(service))
+        except Exception as e:
+            print(f"❌ Ошибка выполнения команды: {e}")
+    
+    with ThreadPoolExecutor(max_workers=len(services)) as pool:
+        futures = {pool.submit(read_probe_output, proc): proc for proc in procs}
+        try:
+            for future in as_completed(futures, timeout=_TIMEOUT):
+                try:
+                    output = future.result()
+                except Exception:
+                    continue
+                ip = output.strip()
+                if futures[future].returncode != 0 or not ip:
+                    continue
+                try:
+                    IPv4Address(ip)
+                except ValueError:
+                    continue
+                print(f"✅ Внешний IP: {ip}")
+                return ip
+        except TimeoutError:
+            pass
+        finally:
+            # Останавливаем оставшиеся curl, чтобы не ждать их таймаута
+            for future, proc in futures.items():
+                future.cancel()
+                kill_command(proc)
     
     print("⚠️  Не удалось определить внешний IP автоматически")
     return None
@@ -139,59 +358,40 @@ def create_env_file(bot_token, admin_id, users, server_config, server_ip):
     """Создание .env файла с конфигурацией"""
     print("\n📝 Создание .env файла...")
     
-    env_content = f"""# Telegram Bot Configuration
-BOT_TOKEN={bot_token}
-
-# Admin Configuration
-ADMIN_ID={admin_id}
-
-# Allowed Users (comma-separated Telegram IDs)
-USERS={users}
-
-# AmneziaWG Configuration
-AWG_CONTAINER=amnezia-awg
-AWG_CONFIG_PATH=/opt/amnezia/awg
-SERVER_ENDPOINT={server_ip}:{server_config.get('PORT', '443')}
-SERVER_PUBLIC_KEY={server_config.get('SERVER_PUBLIC_KEY', '')}
-PRESHARED_KEY={server_config.get('PRESHARED_KEY', '')}
-
-# Network Configuration
-CLIENT_NETWORK={server_config.get('CLIENT_NETWORK', '10.8.1.0/24')}
-CLIENT_IP_START={server_config.get('CLIENT_IP_START', '10.8.1.2')}
-
-# AmneziaWG Parameters
-JC={server_config.get('JC', '2')}
-JMIN={server_config.get('JMIN', '10')}
-JMAX={server_config.get('JMAX', '50')}
-S1={server_config.get('S1', '105')}
-S2={server_config.get('S2', '72')}
-H1={server_config.get('H1', '1632458931')}
-H2={server_config.get('H2', '1121810837')}
-H3={server_config.get('H3', '697439987')}
-H4={server_config.get('H4', '1960185003')}
-
-# DNS Servers
-DNS_SERVERS=1.1.1.1,1.0.0.1
-
-# Database
-DATABASE_PATH=data/database.db
-
-# Logging
-LOG_LEVEL=INFO
-LOG_FILE=logs/bot.log
-"""
+    values = {
+        name: getattr(server_config, name) or default
+        for name, default in ENV_DEFAULTS.items()
+    }
+    env_content = '\n'.join(
+        line.format(
+            bot_token=bot_token,
+            admin_id=admin_id,
+            users=users,
+            server_ip=server_ip,
+            **values
+        )
+        for line in ENV_TEMPLATE_LINES
+    )
     
     env_path = Path(__file__).parent / '.env'
     
-    # Создаем резервную копию, если файл существует
+    # Сначала пишем во временный файл, чтобы .env не остался недописанным.
+    # В .env лежат токен бота и PresharedKey: права берем от старого файла,
+    # для нового - доступ только владельцу
+    tmp_path = env_path.with_name('.env.new')
+    mode = env_path.stat().st_mode & 0o777 if env_path.exists() else 0o600
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, mode)
+    with os.fdopen(fd, 'w', newline='\n') as f:
+        f.write(env_content)
+    
+    # Резервная копия - переименование старого файла, без копирования данных
     if env_path.exists():
-        backup_path = Path(__file__).parent / '.env.backup'
+        backup_path = env_path.with_name('.env.backup')
         print(f"📦 Создание резервной копии: {backup_path}")
-        import shutil
-        shutil.copy(env_path, backup_path)
+        os.replace(env_path, backup_path)
     
-    with open(env_path, 'w') as f:
-        f.write(env_content)
+    os.replace(tmp_path, env_path)
     
     print(f"✅ Файл .env создан: {env_path}")
     return True
@@ -203,12 +403,8 @@ def main():
     print("🚀 AmneziaWG Config Bot - Автоматическая настройка")
     print("=" * 60)
     
-    # Проверка Docker
-    if not check_docker():
-        sys.exit(1)
-    
-    # Проверка контейнера AmneziaWG
-    if not check_amnezia_container():
+    # Проверка Docker и контейнера AmneziaWG
+    if not check_docker_and_container():
         sys.exit(1)
     
     # Получение конфигурации сервера
@@ -218,10 +414,10 @@ def main():
         sys.exit(1)
     
     print("\n✅ Конфигурация сервера получена:")
-    print(f"   - Публичный ключ: {server_config.get('SERVER_PUBLIC_KEY', 'N/A')[:20]}...")
-    print(f"   - Порт: {server_config.get('PORT', 'N/A')}")
-    print(f"   - Сеть клиентов: {server_config.get('CLIENT_NETWORK', 'N/A')}")
-    print(f"   - Следующий IP: {server_config.get('CLIENT_IP_START', 'N/A')}")
+    print(f"   - Публичный ключ: {(server_config.server_public_key or 'N/A')[:20]}...")
+    print(f"   - Порт: {server_config.port or 'N/A'}")
+    print(f"   - Сеть клиентов: {server_config.client_network or 'N/A'}")
+    print(f"   - Следующий IP: {server_config.client_ip_start or 'N/A'}")
     
     # Получение внешнего IP
     server_ip = get_server_ip()
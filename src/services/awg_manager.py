@@ -4,7 +4,7 @@
 import asyncio
 import json
 from pathlib import Path
-from typing import Optional, Tuple, Dict, Any
+from typing import Optional, Tuple, Dict, Any, List
 
 from src.config.settings import settings
 from src.utils.logger import logger
@@ -45,6 +45,39 @@ class AmneziaWGManager:
             logger.error(f"Ошибка выполнения команды '{command}': {e}")
             raise
     
+    async def _execute_argv(
+        self,
+        argv: List[str],
+        stdin: Optional[bytes] = None
+    ) -> Tuple[str, str, int]:
+        """
+        Выполнение команды без shell (список аргументов) через asyncio
+        
+        Args:
+            argv: Команда и ее аргументы
+            stdin: Данные для стандартного ввода команды
+            
+        Returns:
+            Tuple[str, str, int]: (stdout, stderr, return_code)
+        """
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *argv,
+                stdin=asyncio.subprocess.PIPE if stdin is not None else None,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            stdout, stderr = await process.communicate(input=stdin)
+            
+            return (
+                stdout.decode('utf-8').strip(),
+                stderr.decode('utf-8').strip(),
+                process.returncode
+            )
+        except Exception as e:
+            logger.error(f"Ошибка выполнения команды '{' '.join(argv)}': {e}")
+            raise
+    
     async def generate_keypair(self) -> Tuple[str, str]:
         """
         Генерация пары ключей для клиента
@@ -60,8 +93,11 @@ class AmneziaWGManager:
             raise Exception(f"Ошибка генерации приватного ключа: {stderr}")
         
         # Генерируем публичный ключ из приватного
-        public_cmd = f"echo '{private_key}' | docker exec -i {self.container} wg pubkey"
-        public_key, stderr, code = await self._execute_command(public_cmd)
+        # Приватный ключ передается через stdin, без shell и echo
+        public_key, stderr, code = await self._execute_argv(
+            ["docker", "exec", "-i", self.container, "wg", "pubkey"],
+            stdin=private_key.encode() + b"\n"
+        )
         
         if code != 0:
             raise Exception(f"Ошибка генерации публичного ключа: {stderr}")